@@ -0,0 +1,995 @@
+#!/usr/bin/env python3
+"""Preprocess the C sources of a project into self-contained .i translation units.
+
+For every .c file of a project we run ``cpp`` against a temporary flattened
+copy of the file: whenever cpp reports a missing header we look the header up
+inside the project tree, stage a copy next to the temporary file, rewrite the
+include directives to point at the flattened name and retry until the file
+preprocesses cleanly.  The temporary staging paths embedded in the resulting
+.i files are mapped back to the original project paths afterwards, so
+downstream analyses see real source locations.
+"""
+
+import argparse
+import functools
+import io
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+from tqdm import tqdm
+
+# Upper bound on the missing-include resolution loop for a single C file,
+# so a pathological dependency chain cannot spin forever.
+MAX_RESOLUTION_ITERATIONS = 50
+
+# Candidate-sort debug logging, decided once at import instead of probing the
+# filesystem on every lookup.
+
+# Linux >= 3.17; elsewhere the working C text falls back to the staging file.
+_HAVE_MEMFD = hasattr(os, 'memfd_create')
+
+# A 1 MiB pipe keeps verbose cpp output from stalling on a full default-size
+# pipe; the keyword only exists on Python 3.10+ and only works on Linux.
+_PIPE_KWARGS = ({'pipesize': 1 << 20}
+                if sys.version_info >= (3, 10) and sys.platform == 'linux'
+                else {})
+
+
+logger = logging.getLogger(__name__)
+_log_buffer = None
+
+# Patterns for the hot error-parsing and include-flattening paths, compiled
+# once at import instead of per call inside the retry loop.
+_FATAL_MISSING_RE = re.compile(
+    r'fatal error: ([^:\n]+): (?:No such file or directory|file not found)')
+_INCLUDE_KIND_RE = re.compile(r'#include\s*([<"])')
+_FLATTEN_INCLUDE_RE = re.compile(r'(?m)^([ \t]*#include\s*")[^"]*/([^"/]+)"')
+_FLATTEN_INCLUDE_RE_B = re.compile(rb'(?m)^([ \t]*#include\s*")[^"]*/([^"/]+)"')
+
+# Bare quote includes as they appear in already-flattened staged files.
+_QUOTE_INCLUDE_RE_B = re.compile(rb'(?m)^[ \t]*#include[ \t]*"([^"]+)"')
+
+class _TqdmHandler(logging.Handler):
+    """Emit log records through ``tqdm.write`` so they do not tear the bar."""
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def _configure_verbose_logging():
+    """Route debug messages through a memory-buffered, tqdm-aware handler.
+
+    Records are batched in memory and flushed in blocks, so verbose runs do
+    not pay a locked stdout write per message.  ``logging.shutdown`` flushes
+    the buffer at interpreter exit, in workers as well as in the parent.
+    """
+    global _log_buffer
+    if logger.handlers:
+        return
+    _log_buffer = logging.handlers.MemoryHandler(
+        capacity=1000, flushLevel=logging.ERROR, target=_TqdmHandler())
+    logger.addHandler(_log_buffer)
+    logger.setLevel(logging.DEBUG)
+
+
+def _memfd_for_text(text):
+    """Back the working C text with an anonymous in-memory file.
+
+    cpp accepts ``/proc/self/fd/N`` as an input path, so dependency probes
+    can read the rewritten text without bouncing it through tmpfs first.
+    """
+    fd = os.memfd_create('preprocessor_c_text')
+    os.write(fd, text.encode('utf-8', errors='replace'))
+    return fd
+
+
+def get_ramdisk_temp_dir():
+    """Return a fresh scratch directory for staging temporary copies.
+
+    Staged files are small, ephemeral and re-read immediately by cpp, so a
+    RAM-backed location is preferred: /dev/shm (tmpfs on Linux), then the
+    user's runtime dir, then whatever tempfile considers the default.  The
+    mkdtemp call doubles as the writability probe for each candidate.
+    """
+    candidates = ['/dev/shm', os.environ.get('XDG_RUNTIME_DIR'),
+                  tempfile.gettempdir()]
+    for candidate in candidates:
+        if not candidate or not os.path.isdir(candidate):
+            continue
+        try:
+            return tempfile.mkdtemp(prefix='preprocessor_', dir=candidate)
+        except OSError:
+            continue
+    return tempfile.mkdtemp(prefix='preprocessor_')
+
+
+def _load_resolve_cache(cache_path):
+    """Load the cross-run header-resolution cache, empty on any problem."""
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return {}
+
+
+def _save_resolve_cache(cache_path, cache):
+    """Atomically persist the header-resolution cache for the next run."""
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def read_file_with_fallback_encoding(file_path):
+    """Read a text file as utf-8, falling back to latin-1.
+
+    One binary read replaces the old retry loop over four codecs: the first
+    codec that loop tried re-read and re-decoded the whole file before every
+    fallback, and the fallbacks after latin-1 were unreachable since latin-1
+    maps every byte.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+# Directories that never hold project sources worth resolving; descending
+# into them costs inode stats by the thousand on real checkouts.
+_PRUNED_DIRS = {'.git', '.svn', '.hg', 'node_modules', 'build',
+                '__pycache__', '.deps'}
+
+
+def _walk_file_entries(root):
+    """Yield an ``os.DirEntry`` for every regular file under ``root``.
+
+    A single scandir pass reuses the type and stat information the kernel
+    already returned with each directory entry, instead of paying the extra
+    stat() per candidate that ``os.walk`` plus ``os.path.getsize`` costs.
+    Symlinks are not followed and VCS/build-output directories are pruned.
+    """
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in _PRUNED_DIRS:
+                        yield from _walk_file_entries(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+            except OSError:
+                continue
+
+
+@functools.lru_cache(maxsize=4)
+def _project_files(project_path):
+    """One cached scan of the project: ``(name, size, path)`` per file.
+
+    The retry loop asks for files by name over and over while the tree on
+    disk never changes mid-run, so every lookup after the first is served
+    from this snapshot instead of a fresh walk.
+    """
+    return tuple((entry.name, entry.stat(follow_symlinks=False).st_size,
+                  entry.path)
+                 for entry in _walk_file_entries(project_path))
+
+
+def find_c_files(project_path):
+    """List every .c file in the project."""
+    return [path for name, _, path in _project_files(project_path)
+            if name.endswith('.c')]
+
+
+def find_header_directories(project_path):
+    """Find every directory of the project that contains at least one header."""
+    header_dirs = {os.path.dirname(path)
+                   for name, _, path in _project_files(project_path)
+                   if name.endswith('.h')}
+    return sorted(header_dirs)
+
+
+@functools.lru_cache(maxsize=4)
+def _basename_index(project_path):
+    """Map every file name in the project to its paths, biggest first.
+
+    Built once per project root from the cached scan; each missing-header
+    resolution afterwards is a dict lookup instead of a pass over the file
+    list.
+    """
+    buckets = defaultdict(list)
+    for name, size, path in _project_files(project_path):
+        buckets[name].append((size, path))
+    return {name: tuple(path for _, path in sorted(bucket, reverse=True))
+            for name, bucket in buckets.items()}
+
+
+def find_files_by_name(project_path, filename):
+    """Find all files named ``filename`` anywhere in the project tree.
+
+    Matches are returned biggest first: when several candidates share a name
+    the largest one is usually the real implementation rather than a stub.
+    """
+    return list(_basename_index(project_path).get(filename, ()))
+
+
+def get_headers_from_list(project_path, include_paths_list):
+    """Resolve project-relative include paths to the actual files on disk.
+
+    Returns a dict mapping each resolvable entry of ``include_paths_list`` to
+    the chosen source file.
+    """
+    # The index covers every file in the tree, so the old last-resort walk
+    # for unusual extensions is subsumed by the bucket lookup.
+    index = _basename_index(project_path)
+    headers = {}
+    for include_path in include_paths_list:
+        header_name = os.path.basename(include_path)
+        bucket = index.get(header_name, ())
+        found = None
+        # Strategy 1: exact relative-path suffix match.
+        for candidate in bucket:
+            if candidate.endswith(os.sep + include_path):
+                found = candidate
+                break
+        # Strategy 2: same basename anywhere in the project, preferring a
+        # path that at least mentions the include's directory part.
+        if found is None and bucket:
+            for candidate in bucket:
+                if include_path in candidate:
+                    found = candidate
+                    break
+            else:
+                found = bucket[0]
+        if found is not None:
+            headers[include_path] = found
+    return headers
+
+
+def extract_missing_file(err_msg):
+    """Extract the missing include reported by cpp from its stderr output.
+
+    Returns ``(file_name, is_system)``, or ``(None, False)`` when the error
+    is not a missing-include failure.
+    """
+    # cpp's diagnostics are line-oriented, so everything needed lives on
+    # the first "fatal error:" line; the name match runs on that line alone
+    # instead of rescanning a potentially long stderr dump.
+    pos = err_msg.find('fatal error:')
+    if pos == -1:
+        return None, False
+    end = err_msg.find('\n', pos)
+    line = err_msg[pos:end if end != -1 else len(err_msg)]
+    if 'No such file or directory' not in line and 'file not found' not in line:
+        return None, False
+    name_match = _FATAL_MISSING_RE.match(line)
+    if name_match is None:
+        return None, False
+    missing_file = name_match.group(1).strip()
+    include_match = _INCLUDE_KIND_RE.search(err_msg, pos)
+    is_system = include_match is not None and include_match.group(1) == '<'
+    return missing_file, is_system
+
+
+def _replace_bytes(file_path, data):
+    """Swap in new contents for ``file_path`` without touching its old inode.
+
+    Staged files may be hardlinks of project sources; writing a sibling and
+    renaming it over the staged name leaves the original untouched.
+    """
+    tmp_path = file_path + '.new'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def flattening_includes(file_path):
+    """Rewrite path-qualified quote includes in ``file_path`` to bare basenames.
+
+    Works on raw bytes: the directives being edited are plain ASCII, so no
+    decode/encode round trip is needed and the rest of the file is passed
+    through byte-identical whatever its encoding.  Returns the flattened
+    content so callers that need to inspect it can skip a re-read.
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    if b'#include' not in content:
+        return content
+    new_content = _FLATTEN_INCLUDE_RE_B.sub(rb'\1\2"', content)
+    if new_content != content:
+        _replace_bytes(file_path, new_content)
+    return new_content
+
+
+def _stage(src, dst):
+    """Stage ``src`` at ``dst`` via a hardlink, copying when linking fails.
+
+    A link is one inode operation instead of a data copy plus the metadata
+    syscalls shutil.copy2 issues.  It is safe because every later edit of a
+    staged file goes through a write-and-replace, which gives the staged
+    name a fresh inode instead of writing through to the original.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+@functools.lru_cache(maxsize=1024)
+def _include_rewrite(basename):
+    """Return the (pattern, replacement) pair flattening includes of ``basename``.
+
+    The pattern is anchored to line starts so the regex engine only attempts
+    matches where an include directive can actually begin.  Common headers
+    are resolved over and over across a project's C files, so the compiled
+    pair is cached per basename.
+    """
+    pattern = re.compile(
+        r'(?m)^([ \t]*#include\s*")(?:[^"]*/)?'
+        + re.escape(basename) + r'"')
+    return pattern, r'\g<1>' + basename + '"'
+
+
+# Lazily rebuilt alternation over the staging paths of the current map.  The
+# map only ever grows, so its length doubles as a generation counter: the
+# pattern is recompiled on the first postprocess call after new entries land.
+def postprocess(content, temp_to_orig_map):
+    """Map the temporary staging paths in preprocessed output to the originals.
+
+    Takes and returns the output bytes, so the substitution happens on the
+    buffer cpp just produced instead of on a file written and re-read from
+    disk.  Everything is bytes-level; keys are sorted longest first so a
+    nested staging path always wins over a shorter prefix of it.
+    """
+    if not temp_to_orig_map or not content:
+        return content
+    replacements = {os.fsencode(k): os.fsencode(v)
+                    for k, v in temp_to_orig_map.items()}
+    keys = sorted(replacements, key=len, reverse=True)
+    regex = re.compile(b'|'.join(re.escape(k) for k in keys))
+    return regex.sub(lambda m: replacements[m.group(0)], content)
+
+
+def run_dependency_probe(cmd, pass_fds=(), base_dir=None):
+    """Run a ``cpp -M -MG`` probe and return ``(success, stderr, missing)``.
+
+    With ``-MG`` cpp records headers it cannot find as to-be-generated
+    dependencies instead of stopping at the first one, so a single probe
+    names every missing include of the file at once.  ``missing`` holds the
+    listed dependencies that do not exist on disk, in include order.  cpp
+    emits to-be-generated entries as the literal include text, so relative
+    names are checked against ``base_dir`` (the staging dir), not the
+    process working directory.
+    """
+    logger.debug('Running: %s', ' '.join(cmd))
+    # Without pass_fds the child can be started through posix_spawn, which
+    # skips the fork-side fd sweep and page-table copy; passing a memfd
+    # forces the slower fork path, so close_fds follows the fd list.
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True,
+                            bufsize=io.DEFAULT_BUFFER_SIZE, pass_fds=pass_fds,
+                            close_fds=bool(pass_fds), **_PIPE_KWARGS)
+    if result.returncode != 0:
+        return False, result.stderr, []
+    deps = result.stdout.replace('\\\n', ' ').partition(':')[2].split()
+    missing = []
+    for dep in dict.fromkeys(deps):
+        path = dep
+        if base_dir is not None and not os.path.isabs(dep):
+            path = os.path.join(base_dir, dep)
+        if not os.path.exists(path):
+            missing.append(dep)
+    return True, result.stderr, missing
+
+
+def run_final_preprocess(cmd):
+    """Run the final ``cpp -E`` pass and return ``(success, stderr, output)``.
+
+    The preprocessed output is collected from stdout as bytes, so it flows
+    straight into postprocess and is written to disk exactly once instead
+    of going through a temp file that is immediately read back.  stderr is
+    drained on a side thread line by line: once a fatal error plus its
+    caret context has been read the process is killed instead of being
+    left to grind through the rest of the file, and the capture is capped
+    so a diagnostic storm cannot balloon memory.
+    """
+    logger.debug('Running: %s', ' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=False,
+                            **_PIPE_KWARGS)
+    captured = []
+    fatal_seen = False
+
+    def drain_stderr():
+        nonlocal fatal_seen
+        context_lines = 0
+        with proc.stderr:
+            for raw_line in proc.stderr:
+                if len(captured) < 256:
+                    captured.append(raw_line)
+                if fatal_seen:
+                    context_lines += 1
+                    if b'#include' in raw_line or context_lines >= 8:
+                        proc.kill()
+                        break
+                elif b'fatal error:' in raw_line:
+                    fatal_seen = True
+
+    # stdout and stderr are consumed concurrently so neither pipe can fill
+    # up and deadlock the other.
+    drainer = threading.Thread(target=drain_stderr)
+    drainer.start()
+    with proc.stdout:
+        output = proc.stdout.read()
+    returncode = proc.wait()
+    drainer.join()
+    err_msg = b''.join(captured).decode('utf-8', errors='replace')
+    return returncode == 0 and not fatal_seen, err_msg, output
+
+
+def setup_directories(project_out_dir, c_files, prefix_len):
+    """Create the output directories every C file will write into.
+
+    Only the directories that will actually receive a .i file are made,
+    once each, instead of mirroring the whole project tree and then
+    re-checking parents from the per-file loop.
+    """
+    os.makedirs(project_out_dir, exist_ok=True)
+    for out_dir in {os.path.dirname(c_file[prefix_len:]) for c_file in c_files}:
+        if out_dir:
+            os.makedirs(os.path.join(project_out_dir, out_dir), exist_ok=True)
+
+
+# Per-worker state installed by _init_worker: each pool worker resolves and
+# stages files independently, sharing nothing but the filesystem.
+_worker_state = {}
+
+# Per-worker counterparts of the caches the sequential loop kept as locals:
+# the created-directory set and the cross-file header resolutions.
+# _unresolvable is the negative side of the resolution cache: a header that
+# was absent for one file is absent for all of them, so later files fail
+# fast instead of redoing the lookup dance.  In --threads mode these are
+# shared across workers, which is safe: every mutation is a single dict or
+# set operation, and a duplicated makedirs or header lookup is harmless.
+_created_dirs = set()
+_resolved_headers = {}
+_unresolvable = set()
+# Flattened copies of headers this worker has staged before, keyed by the
+# source path.  The first staging reads and rewrites the header into the
+# worker's cache dir; every later staging is a hardlink of that copy.
+_flattened_cache = {}
+_cache_seq = itertools.count()
+_thread_state = threading.local()
+
+
+def _error_buffer():
+    """Reusable error buffer, one per worker thread (or process)."""
+    buf = getattr(_thread_state, 'error_buf', None)
+    if buf is None:
+        buf = _thread_state.error_buf = io.StringIO()
+    return buf
+
+
+def _stage_flattened(src, dest):
+    """Stage a flattened copy of ``src`` at ``dest``; return its quote includes.
+
+    Headers shared by many C files are flattened once into the worker's
+    cache dir and hardlinked from there afterwards, so repeat stagings cost
+    one inode operation instead of a read plus a regex rewrite.  An
+    existing ``dest`` is unlinked first: overwriting it in place would
+    write through the hardlink into whatever file it still shares an inode
+    with.
+    """
+    entry = _flattened_cache.get(src)
+    if entry is None:
+        cache_path = os.path.join(
+            _worker_state['header_cache_dir'],
+            f'{next(_cache_seq)}_{os.path.basename(src)}')
+        _ensure_dir(os.path.dirname(cache_path))
+        _stage(src, cache_path)
+        content = flattening_includes(cache_path)
+        names = tuple(os.fsdecode(m.group(1))
+                      for m in _QUOTE_INCLUDE_RE_B.finditer(content))
+        entry = _flattened_cache[src] = (cache_path, names)
+    if os.path.exists(dest):
+        os.unlink(dest)
+    _stage(entry[0], dest)
+    return entry[1]
+
+
+def _ensure_dir(path):
+    """makedirs, skipping the syscall for directories this worker made already."""
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+
+def _init_worker(project_path, project_out_dir, tmp_base_dir, include_paths,
+                 header_dirs, resolve_cache, verbose):
+    _worker_state.update(
+        project_path=project_path, project_out_dir=project_out_dir,
+        tmp_base_dir=tmp_base_dir, include_paths=include_paths,
+        header_dirs=header_dirs,
+        resolve_cache=resolve_cache, verbose=verbose,
+        # The extra -I flags never change; only the per-file staging dir
+        # flag has to be prepended for each file.
+        include_flag_tail=tuple(f'-I{path}' for path in include_paths),
+        header_cache_dir=os.path.join(tmp_base_dir,
+                                      f'hdrcache{os.getpid()}'),
+        # Precomputed once so per-file relative paths are a plain slice
+        # instead of an os.path.relpath parse.
+        project_prefix_len=len(project_path.rstrip(os.sep)) + 1)
+    if verbose:
+        _configure_verbose_logging()
+
+
+def preprocess_file(c_file):
+    """Resolve, stage and preprocess a single C file.
+
+    Runs inside a pool worker set up by ``_init_worker``.  Returns
+    ``(rel_path, ok, error_text, cache_entry)`` where ``error_text`` is
+    empty and ``cache_entry`` records the resolved header set on success.
+    """
+    project_path = _worker_state['project_path']
+    project_out_dir = _worker_state['project_out_dir']
+    tmp_base_dir = _worker_state['tmp_base_dir']
+    header_dirs = _worker_state['header_dirs']
+
+    rel_path = c_file[_worker_state['project_prefix_len']:]
+    # Output directories are pre-created by setup_directories.
+    out_path = os.path.join(
+        project_out_dir, os.path.splitext(rel_path)[0] + '.i')
+
+    # The crc32 suffix keeps the name collision-free: flattening the
+    # separators alone would map e.g. a/b.c and a_b.c to the same staging
+    # dir and race concurrent workers against each other.
+    tmp_dir = os.path.join(
+        tmp_base_dir,
+        f"{rel_path.replace(os.sep, '_')}_{zlib.crc32(rel_path.encode()):08x}")
+    _ensure_dir(tmp_dir)
+    c_file_tmp = os.path.join(tmp_dir, os.path.basename(c_file))
+    # The working copy of the C text lives in memory; it only hits the
+    # staging dir when cpp needs a real file (no memfd support, or the
+    # final -E run whose linemarkers feed postprocess).
+    original_text = read_file_with_fallback_encoding(c_file)
+    c_text = _FLATTEN_INCLUDE_RE.sub(r'\1\2"', original_text)
+    c_dirty = True
+
+    def write_working_copy():
+        nonlocal c_dirty
+        if c_dirty:
+            with open(c_file_tmp, 'w', encoding='utf-8', errors='replace') as f:
+                f.write(c_text)
+            c_dirty = False
+
+    def probe_missing():
+        if _HAVE_MEMFD:
+            fd = _memfd_for_text(c_text)
+            try:
+                return run_dependency_probe(
+                    dep_cmd + (f'/proc/self/fd/{fd}',), pass_fds=(fd,),
+                    base_dir=tmp_dir)
+            finally:
+                os.close(fd)
+        write_working_copy()
+        return run_dependency_probe(dep_cmd + (c_file_tmp,),
+                                    base_dir=tmp_dir)
+
+    temp_to_orig_map = {c_file_tmp: c_file}
+    _error_buf = _error_buffer()
+    _error_buf.truncate(0)
+    _error_buf.seek(0)
+
+    # Stage the headers the file names explicitly before probing, so the
+    # resolution loop only has to deal with transitive includes.
+    include_directives = re.findall(r'#include\s+"([^"]+)"', original_text)
+    known_headers = get_headers_from_list(project_path, include_directives)
+    for include_path, src in known_headers.items():
+        dest = os.path.join(tmp_dir, os.path.basename(include_path))
+        _ensure_dir(os.path.dirname(dest))
+        _stage_flattened(src, dest)
+        temp_to_orig_map[dest] = src
+        _resolved_headers.setdefault(os.path.basename(dest), src)
+
+    # Seed the staging dir with everything this worker resolved earlier.
+    for res_basename, res_src in _resolved_headers.items():
+        dest = os.path.join(tmp_dir, res_basename)
+        if os.path.exists(dest):
+            continue
+        _stage_flattened(res_src, dest)
+        temp_to_orig_map[dest] = res_src
+
+    # Cross-run cache: when neither this file nor any header it resolved
+    # to last run has changed, the whole set is staged up front and the
+    # first probe comes back clean, skipping the resolution work entirely.
+    cached = _worker_state['resolve_cache'].get(c_file)
+    if cached is not None:
+        entry_mtime, entry_size, entry_headers = cached
+        try:
+            c_stat = os.stat(c_file)
+            fresh = (entry_mtime == c_stat.st_mtime_ns
+                     and entry_size == c_stat.st_size
+                     and all(os.stat(p).st_mtime_ns == m
+                             and os.stat(p).st_size == s
+                             for p, m, s in entry_headers))
+        except OSError:
+            fresh = False
+        if fresh:
+            for src_path, _, _ in entry_headers:
+                dest = os.path.join(tmp_dir, os.path.basename(src_path))
+                if os.path.exists(dest):
+                    continue
+                _stage_flattened(src_path, dest)
+                temp_to_orig_map[dest] = src_path
+
+    include_flags = (f'-I{tmp_dir}',) + _worker_state['include_flag_tail']
+    # Built once per C file; every probe just appends the input path.
+    dep_cmd = ('cpp', '-M', '-MG', *include_flags)
+
+    # Candidates already staged for each missing basename, so a later
+    # failure can move on to the next match instead of aborting, and
+    # circularity is only declared once every candidate is exhausted.
+    attempted = {}
+    is_processable = True
+    iteration_count = 0
+    final_cmd = ('cpp', '-E', *include_flags, c_file_tmp)
+
+    # Optimistic first pass: the staging dir was just seeded from the
+    # resolve cache and this worker's earlier resolutions, so in steady
+    # state most files preprocess cleanly on the first try and the
+    # dependency probe is never spawned for them.
+    write_working_copy()
+    success, err_msg, output = run_final_preprocess(final_cmd)
+
+    while not success and is_processable:
+        iteration_count += 1
+        if iteration_count > MAX_RESOLUTION_ITERATIONS:
+            _error_buf.write(
+                f'Giving up after {MAX_RESOLUTION_ITERATIONS} '
+                f'resolution attempts\n')
+            is_processable = False
+            break
+
+        probe_ok, err_msg, missing_files = probe_missing()
+        if not probe_ok:
+            # -MG swallows missing includes, so a failed probe is some
+            # other preprocessing error; a missing-include message can
+            # still surface from unreadable or malformed headers, in
+            # which case that one file goes through resolution below.
+            missing_file, is_system = extract_missing_file(err_msg)
+            if is_system:
+                _error_buf.write(
+                    f'Unresolvable system include <{missing_file}>\n')
+                _error_buf.write(err_msg)
+                is_processable = False
+                break
+            if missing_file is None:
+                _error_buf.write(err_msg)
+                is_processable = False
+                break
+            missing_files = [missing_file]
+        if not missing_files:
+            break
+
+        # Every missing header of this round is staged before the next
+        # probe, so the probe count scales with the include-tree depth
+        # rather than with the number of missing files.
+        # Resolve the transitive include closure in one go: the quote
+        # includes of each staged header are queued and resolved straight
+        # from the index, instead of waiting for another probe to report
+        # them one dependency level at a time.
+        staged_this_round = []
+        round_includes = set()
+        queue = list(missing_files)
+        queued = {os.path.basename(m) for m in queue}
+        # Only the probe's own reports may fail the file: a name harvested
+        # from a staged header can still be resolvable by cpp through the
+        # user's -I paths or the system search, so a lookup miss there just
+        # leaves the name to the next probe (or the final -E) to judge.
+        probe_reported = set(queued)
+        while queue:
+            missing_file = queue.pop()
+            basename = os.path.basename(missing_file)
+            from_probe = basename in probe_reported
+            logger.debug('Missing include: %s', missing_file)
+            if basename in _unresolvable:
+                if not from_probe:
+                    continue
+                _error_buf.write(
+                    f'Could not find {missing_file} in the project '
+                    f'(cached)\n')
+                is_processable = False
+                break
+            matches = find_files_by_name(project_path, basename)
+            if not matches:
+                for header_dir in header_dirs:
+                    candidate = os.path.join(header_dir, missing_file)
+                    if os.path.exists(candidate):
+                        matches = [candidate]
+                        break
+                else:
+                    if not from_probe:
+                        continue
+                    _unresolvable.add(basename)
+
+            tried = attempted.setdefault(basename, set())
+            candidates = [m for m in matches if m not in tried]
+            if not candidates:
+                if not from_probe:
+                    continue
+                if tried:
+                    _error_buf.write(
+                        f'Exhausted all {len(tried)} candidate(s) for '
+                        f'{basename}; likely circular dependency\n')
+                else:
+                    _error_buf.write(
+                        f'Could not find {missing_file} in the project\n')
+                _error_buf.write(err_msg)
+                is_processable = False
+                break
+
+            match = candidates[0]
+            tried.add(match)
+            dest = os.path.join(tmp_dir, basename)
+            _ensure_dir(os.path.dirname(dest))
+            names = _stage_flattened(match, dest)
+            round_includes.update(names)
+            for name in names:
+                if (name not in queued
+                        and not os.path.exists(os.path.join(tmp_dir, name))):
+                    queued.add(name)
+                    queue.append(name)
+            if basename in c_text:
+                pattern, replacement = _include_rewrite(basename)
+                new_c_text = pattern.sub(replacement, c_text)
+                if new_c_text != c_text:
+                    c_text = new_c_text
+                    c_dirty = True
+            staged_this_round.append(basename)
+            temp_to_orig_map[dest] = match
+            _resolved_headers[basename] = match
+            logger.debug('Staged %s -> %s', match, dest)
+
+        if is_processable and staged_this_round:
+            # When every quote include of the headers staged this round is
+            # already in the staging dir, the next probe cannot report
+            # anything new, so the extra cpp spawn is skipped.  A missing
+            # system header hiding behind a staged one is left to the final
+            # -E run, whose own fatal diagnostic covers that rare case.
+            staged_names = {entry.name for entry in os.scandir(tmp_dir)}
+            if round_includes <= staged_names:
+                break
+
+    if not success and is_processable:
+        write_working_copy()
+        success, err_msg, output = run_final_preprocess(final_cmd)
+    if is_processable:
+        if success:
+            output = postprocess(output, temp_to_orig_map)
+            # Written next to the destination and moved into place, so a
+            # crash mid-write can never leave a truncated .i file behind.
+            out_tmp = out_path + '.tmp'
+            with open(out_tmp, 'wb') as f:
+                f.write(output)
+            os.replace(out_tmp, out_path)
+            # Drop this file's staging dir right away so the temp footprint
+            # stays constant instead of growing with the project; failed
+            # files keep theirs for diagnosis until the end-of-run cleanup.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            _created_dirs.discard(tmp_dir)
+            logger.debug('Wrote %s.i', os.path.splitext(rel_path)[0])
+            if _log_buffer is not None:
+                # Pool workers exit through os._exit, so nothing flushes the
+                # buffer at interpreter shutdown; one flush per file keeps
+                # the batching while making sure no messages are lost.
+                _log_buffer.flush()
+            staged = []
+            for dest, orig in temp_to_orig_map.items():
+                if dest == c_file_tmp:
+                    continue
+                st = os.stat(orig)
+                staged.append((orig, st.st_mtime_ns, st.st_size))
+            c_stat = os.stat(c_file)
+            cache_entry = (c_stat.st_mtime_ns, c_stat.st_size, tuple(staged))
+            return rel_path, True, '', cache_entry
+        _error_buf.write(err_msg)
+        logger.debug('Error during final preprocessing of %s', rel_path)
+    else:
+        logger.debug('Skipped %s', rel_path)
+    if _log_buffer is not None:
+        _log_buffer.flush()
+    return rel_path, False, _error_buf.getvalue(), None
+
+
+def preprocess_project(project_path, output_base_dir, include_paths=None,
+                       verbose=False, use_threads=False):
+    """Preprocess every C file of ``project_path`` into ``output_base_dir``.
+
+    Files are independent, so they are farmed out to a process pool; the
+    main process only tallies results and writes the error logs.  With
+    ``use_threads`` a thread pool is used instead: the per-file work is
+    dominated by cpp subprocesses and file IO, which release the GIL, and
+    threads share the filename index and resolution caches in-process
+    without any submit-time pickling.  Returns
+    ``(processed_files, skipped_files)``.
+    """
+    include_paths = include_paths or []
+    project_path = os.path.abspath(project_path)
+    project_name = os.path.basename(os.path.normpath(project_path))
+    project_out_dir = os.path.join(output_base_dir, project_name)
+    tmp_base_dir = get_ramdisk_temp_dir()
+    if verbose:
+        _configure_verbose_logging()
+
+    c_files = find_c_files(project_path)
+    header_dirs = find_header_directories(project_path)
+    prefix_len = len(project_path.rstrip(os.sep)) + 1
+    setup_directories(project_out_dir, c_files, prefix_len)
+
+    processed_files = 0
+    skipped_files = 0
+    # Incremental re-runs: a file whose output is already newer than its
+    # source has nothing to redo, so only the changed files reach the pool.
+    # The check is source-mtime only; touch the .c file (or clear the output
+    # directory) after editing a shared header to force regeneration.
+    stale_files = []
+    for c_file in c_files:
+        out_path = os.path.join(
+            project_out_dir, os.path.splitext(c_file[prefix_len:])[0] + '.i')
+        try:
+            if os.stat(out_path).st_mtime_ns >= os.stat(c_file).st_mtime_ns:
+                processed_files += 1
+                continue
+        except OSError:
+            pass
+        stale_files.append(c_file)
+    # Let tqdm coalesce renders; re-rendering the bar per completed file can
+    # rival the work itself on small-file-heavy projects.
+    progress_bar = tqdm(total=len(c_files), desc=project_name, unit='file',
+                        initial=processed_files, mininterval=0.5,
+                        miniters=max(1, len(c_files) // 100), smoothing=0.1)
+
+    # One buffered log for every failure in the run, instead of an open/
+    # write/close cycle per skipped file.
+    err_log_path = os.path.join(project_out_dir, 'errors.log')
+    err_fh = io.open(err_log_path, 'w', buffering=1 << 20, encoding='utf-8')
+
+    # Resolved header sets from earlier runs; entries for files that no
+    # longer exist are dropped, everything else carries over.
+    cache_path = os.path.join(project_out_dir, '.preproc_cache.pkl')
+    resolve_cache = _load_resolve_cache(cache_path)
+    c_files_set = set(c_files)
+    resolve_cache = {k: v for k, v in resolve_cache.items()
+                     if k in c_files_set}
+
+    initargs = (project_path, project_out_dir, tmp_base_dir, include_paths,
+                header_dirs, resolve_cache, verbose)
+
+    if use_threads:
+        # Threads block in subprocess waits most of the time, so the pool
+        # is oversubscribed relative to the core count.
+        max_workers = min(32, (os.cpu_count() or 4) * 2)
+        _init_worker(*initargs)
+        executor_cm = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        # forkserver sidesteps both the per-worker reimport cost of spawn
+        # and the lock/fd inheritance hazards of bare fork.  Preloading
+        # this module into the server makes every worker a plain fork of an
+        # interpreter that has already paid the import cost, instead of
+        # reimporting per worker.
+        mp_context = multiprocessing.get_context('forkserver')
+        mp_context.set_forkserver_preload(
+            ['preprocessor' if __name__ == '__main__' else __name__])
+        max_workers = os.cpu_count() or 4
+        executor_cm = ProcessPoolExecutor(max_workers=max_workers,
+                                          mp_context=mp_context,
+                                          initializer=_init_worker,
+                                          initargs=initargs)
+    try:
+        with executor_cm as executor:
+            # Keep a bounded window of tasks in flight instead of submitting
+            # every file upfront: results are consumed as workers finish and
+            # each completion feeds the next file in, so queue memory stays
+            # constant no matter how large the project is.
+            file_iter = iter(stale_files)
+            pending = {executor.submit(preprocess_file, c_file)
+                       for c_file in itertools.islice(file_iter, max_workers * 4)}
+            # Completions are reported to tqdm in batches; per-future
+            # update(1) calls serialize on the bar's lock and can become
+            # the bottleneck when small files finish by the thousands.
+            unreported = 0
+            last_flush = time.monotonic()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_file = next(file_iter, None)
+                    if next_file is not None:
+                        pending.add(executor.submit(preprocess_file, next_file))
+                    rel_path, ok, error_text, cache_entry = future.result()
+                    out_path = os.path.join(
+                        project_out_dir, os.path.splitext(rel_path)[0] + '.i')
+                    err_path = out_path + '.err'
+                    if ok:
+                        processed_files += 1
+                        if cache_entry is not None:
+                            resolve_cache[os.path.join(project_path,
+                                                       rel_path)] = cache_entry
+                        # Clear any stale .err from an earlier run in one
+                        # syscall instead of a stat followed by an unlink.
+                        try:
+                            os.unlink(err_path)
+                        except FileNotFoundError:
+                            pass
+                    else:
+                        skipped_files += 1
+                        err_fh.write(f'Error log for {rel_path}:\n'
+                                     + '=' * 80 + '\n' + error_text)
+                    unreported += 1
+                    now = time.monotonic()
+                    if unreported >= 32 or now - last_flush > 0.25:
+                        progress_bar.update(unreported)
+                        progress_bar.set_postfix_str(
+                            f'ok={processed_files} skip={skipped_files}',
+                            refresh=False)
+                        unreported = 0
+                        last_flush = now
+            if unreported:
+                progress_bar.update(unreported)
+                progress_bar.set_postfix_str(
+                    f'ok={processed_files} skip={skipped_files}',
+                    refresh=False)
+    finally:
+        progress_bar.close()
+        err_fh.close()
+        shutil.rmtree(tmp_base_dir, ignore_errors=True)
+
+    _save_resolve_cache(cache_path, resolve_cache)
+    if skipped_files == 0:
+        os.remove(err_log_path)
+    return processed_files, skipped_files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Flatten and preprocess the C files of a project.')
+    parser.add_argument('project_path', help='Root directory of the C project')
+    parser.add_argument('output_dir', help='Directory for the preprocessed output')
+    parser.add_argument('-I', '--include-paths', nargs='*', default=[],
+                        help='Extra include directories passed to cpp')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print per-file resolution details')
+    parser.add_argument('-t', '--threads', action='store_true',
+                        help='Use a thread pool instead of worker processes')
+    args = parser.parse_args()
+
+    processed, skipped = preprocess_project(
+        args.project_path, args.output_dir, args.include_paths, args.verbose,
+        use_threads=args.threads)
+    print(f'Processed {processed} file(s), skipped {skipped} file(s).')
+    return 0 if skipped == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())